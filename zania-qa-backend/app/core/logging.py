@@ -14,8 +14,8 @@ def setup_logging():
     if logger.handlers:
         return logger
 
-    # Default to INFO level; can be overridden via env if needed
-    logger.setLevel(logging.INFO)
+    # Default to INFO level; override via LOG_LEVEL (e.g. DEBUG in development)
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 
     # Consistent timestamped log format
     formatter = logging.Formatter(
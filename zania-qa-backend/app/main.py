@@ -1,9 +1,12 @@
 import os
-import json
-import shutil
+import asyncio
+import hashlib
 import tempfile
-import traceback
+
+import orjson
+import aiofiles
 from fastapi import FastAPI, UploadFile, HTTPException
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 
 # Local imports
@@ -17,8 +20,18 @@ from app.core.logging import setup_logging
 load_dotenv()
 logger = setup_logging()
 
-# Initialize the FastAPI app
-app = FastAPI(title="Zania RAG Backend", version="1.0.0")
+# Initialize the FastAPI app — orjson (Rust-backed) serializes responses
+# several times faster than stdlib json
+app = FastAPI(title="Zania RAG Backend", version="1.0.0", default_response_class=ORJSONResponse)
+
+# Cap concurrent QA invocations so a large questions.json doesn't trip OpenAI rate limits
+QA_CONCURRENCY_LIMIT = 8
+
+# RAM cache of built QA chains keyed by document hash — repeat uploads of the
+# same knowledge base skip loading, indexing, and chain construction entirely.
+# (Cold restarts still warm up quickly from the on-disk FAISS/document caches.)
+_qa_chain_cache: dict[str, object] = {}
+QA_CHAIN_CACHE_MAX = 8
 
 
 @app.on_event("startup")
@@ -56,44 +69,75 @@ async def qa_endpoint(document: UploadFile, questions: UploadFile):
     try:
         # Step 2: Write uploaded files to temporary storage
         # (ensures compatibility with file loaders that expect file paths)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=doc_suffix) as temp_doc, \
-             tempfile.NamedTemporaryFile(delete=False, suffix=q_suffix) as temp_q:
-            shutil.copyfileobj(document.file, temp_doc)
-            shutil.copyfileobj(questions.file, temp_q)
-
-        # Step 3: Parse and chunk the knowledge base
-        docs = load_documents(temp_doc.name)
-        if not docs:
-            raise HTTPException(status_code=400, detail="No documents could be loaded from the knowledge base.")
-        print(f"✅ Loaded {len(docs)} chunks from {document.filename}")
-
-        # Step 4: Initialize retriever and QA chain
-        retriever = build_retriever(docs)
-        qa_chain = build_qa_chain(retriever)
+        # Reserve a temp file name, then persist the document asynchronously so
+        # the event loop stays free to serve other requests during disk I/O.
+        # The document is hashed while being written so identical uploads can
+        # reuse the persisted FAISS/BM25 indexes instead of re-embedding.
+        # (The questions file is small and parsed straight from memory below —
+        # no temp-file round-trip needed.)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=doc_suffix) as temp_doc:
+            pass
 
-        # Step 5: Parse the questions file
-        with open(temp_q.name, "r") as f:
-            questions_json = json.load(f)
+        doc_hasher = hashlib.sha256()
+        async with aiofiles.open(temp_doc.name, "wb") as f:
+            while chunk := await document.read(1 << 20):
+                doc_hasher.update(chunk)
+                await f.write(chunk)
+        doc_hash = doc_hasher.hexdigest()
+
+        # Steps 3–4: Parse/chunk the knowledge base and build the QA chain,
+        # unless an identical document was already indexed this process
+        qa_chain = _qa_chain_cache.get(doc_hash)
+        if qa_chain is None:
+            docs = load_documents(temp_doc.name, cache_key=doc_hash)
+            if not docs:
+                raise HTTPException(status_code=400, detail="No documents could be loaded from the knowledge base.")
+            logger.debug("Loaded %d chunks from %s", len(docs), document.filename)
+
+            retriever = await build_retriever(docs, cache_key=doc_hash)
+            qa_chain = build_qa_chain(retriever)
+
+            # Bound the cache; evict the oldest entry first
+            if len(_qa_chain_cache) >= QA_CHAIN_CACHE_MAX:
+                _qa_chain_cache.pop(next(iter(_qa_chain_cache)))
+            _qa_chain_cache[doc_hash] = qa_chain
+        else:
+            logger.debug("Reusing cached QA chain for document %s…", doc_hash[:12])
+
+        # Step 5: Parse the questions file directly from the upload body
+        try:
+            questions_json = orjson.loads(await questions.read())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Questions file is not valid JSON.")
 
         if "questions" not in questions_json or not isinstance(questions_json["questions"], list):
             raise HTTPException(status_code=400, detail="Invalid questions.json: must contain a 'questions' list.")
 
-        # Step 6: Run inference for each question
-        results = []
-        for idx, q in enumerate(questions_json["questions"], start=1):
-            q = q.strip()
-            if not q:
-                continue
-
-            print(f"\n🔍 Processing Q{idx}: {q}")
-            try:
-                result = qa_chain.invoke({"query": q})
-                answer = result.get("result", "").strip() or "No answer generated."
-            except Exception as e:
-                traceback.print_exc()
-                answer = f"Error during QA execution: {str(e)}"
-
-            results.append({"question": q, "answer": answer})
+        # Step 6: Run inference for all questions concurrently
+        # Each question is independent and network-bound (MultiQuery expansion +
+        # compression + final completion), so firing them through asyncio.gather
+        # collapses N serial OpenAI round-trips into one concurrent window.
+        semaphore = asyncio.Semaphore(QA_CONCURRENCY_LIMIT)
+
+        async def answer_question(idx: int, q: str) -> dict:
+            """Run a single question through the QA chain, preserving per-question errors."""
+            async with semaphore:
+                logger.debug("Processing Q%d: %s", idx, q)
+                try:
+                    result = await qa_chain.ainvoke({"query": q})
+                    answer = result.get("result", "").strip() or "No answer generated."
+                except Exception as e:
+                    logger.exception("QA execution failed for Q%d", idx)
+                    answer = f"Error during QA execution: {str(e)}"
+                return {"question": q, "answer": answer}
+
+        pending = [
+            answer_question(idx, q.strip())
+            for idx, q in enumerate(questions_json["questions"], start=1)
+            if q.strip()
+        ]
+        # gather preserves input order, so answers line up with the questions list
+        results = list(await asyncio.gather(*pending))
 
         # Step 7: Return structured output
         return {"answers": results}
@@ -103,16 +147,14 @@ async def qa_endpoint(document: UploadFile, questions: UploadFile):
         raise
     except Exception as e:
         # Catch unexpected exceptions and return a clean 500 response
-        traceback.print_exc()
+        logger.exception("Unhandled error in /qa")
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
     finally:
-        # Step 8: Clean up temporary files
+        # Step 8: Clean up the temporary document file
         try:
             if "temp_doc" in locals() and os.path.exists(temp_doc.name):
                 os.remove(temp_doc.name)
-            if "temp_q" in locals() and os.path.exists(temp_q.name):
-                os.remove(temp_q.name)
         except Exception:
             # Avoid secondary errors during cleanup
             pass
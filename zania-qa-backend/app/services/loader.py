@@ -1,37 +1,113 @@
-from langchain_community.document_loaders import PyPDFLoader
+from langchain_community.document_loaders import PyMuPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
+from functools import lru_cache
 from pathlib import Path
+from typing import Optional
+import logging
+import pickle
 import json
 
-def load_documents(file_path: str):
+import lz4.frame
+
+logger = logging.getLogger("zania")
+
+# Parsed + chunked documents cached per upload hash — repeat uploads of the
+# same file skip the PDF parse and splitter passes (the dominant CPU cost
+# of a warm request)
+DOC_CACHE_DIR = Path("cache/docs")
+
+
+def _doc_cache_get(cache_key):
+    """Return cached Documents for this upload hash, or None on a miss."""
+    if not cache_key:
+        return None
+    cache_path = DOC_CACHE_DIR / f"{cache_key}.pkl"
+    try:
+        if cache_path.exists():
+            with open(cache_path, "rb") as f:
+                return pickle.loads(lz4.frame.decompress(f.read()))
+    except Exception:
+        # A corrupt cache entry should never break loading — reparse instead
+        pass
+    return None
+
+
+def _doc_cache_put(cache_key, docs) -> None:
+    """Persist chunked Documents for this upload hash (best-effort)."""
+    if not cache_key:
+        return
+    try:
+        DOC_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(DOC_CACHE_DIR / f"{cache_key}.pkl", "wb") as f:
+            f.write(lz4.frame.compress(pickle.dumps(docs)))
+    except Exception:
+        pass
+
+# Splitting on paragraph/sentence boundaries keeps chunks semantically coherent
+SPLIT_SEPARATORS = ["\n\n", "\n", ".", " "]
+
+
+@lru_cache(maxsize=1)
+def _get_splitter():
+    """
+    Return the shared text splitter, built once per process.
+
+    Chunks are sized in tokens (cl100k_base, the encoding used by OpenAI's
+    embedding models) rather than characters, so chunk boundaries line up with
+    what the embedding model actually sees. The lru_cache keeps the tiktoken
+    tokenizer loaded instead of re-initializing it per request.
+    """
+    try:
+        return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            encoding_name="cl100k_base",
+            chunk_size=512,
+            chunk_overlap=50,
+            separators=SPLIT_SEPARATORS,
+        )
+    except Exception:
+        # tiktoken downloads its BPE table on first use; if that isn't possible
+        # (e.g. offline environment), fall back to character-length splitting
+        return RecursiveCharacterTextSplitter(
+            chunk_size=2500,
+            chunk_overlap=400,
+            length_function=len,
+            separators=SPLIT_SEPARATORS,
+        )
+
+def load_documents(file_path: str, cache_key: Optional[str] = None):
     """
     Load and preprocess documents from either a PDF or JSON file.
     Returns a list of LangChain Document objects ready for downstream retrieval.
+
+    When `cache_key` (the SHA256 of the uploaded file) is given, chunked
+    results are cached under cache/docs/ and reused for identical uploads.
     """
+    cached = _doc_cache_get(cache_key)
+    if cached is not None:
+        logger.debug("Reusing cached document chunks for upload %s…", cache_key[:12])
+        return cached
+
     path = Path(file_path)
 
     # Case 1: PDF documents (knowledge base or reference material)
     if path.suffix.lower() == ".pdf":
-        # Use LangChain's PDF loader to extract text from all pages
-        loader = PyPDFLoader(file_path)
-        raw_docs = loader.load()
+        # PyMuPDF's C-based extractor is several times faster than pypdf;
+        # lazy_load streams one page at a time instead of materializing
+        # the whole document up front
+        loader = PyMuPDFLoader(file_path)
 
-        # Split long text into overlapping chunks for better context retention
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=2500,
-            chunk_overlap=400,
-            length_function=len,
-            separators=["\n\n", "\n", ".", " "],  # prefer splitting on paragraph or sentence breaks
-        )
-        docs = splitter.split_documents(raw_docs)
+        # Split long text into overlapping token-counted chunks
+        splitter = _get_splitter()
+        docs = splitter.split_documents(loader.lazy_load())
 
         # Add basic metadata for traceability
         for doc in docs:
             doc.metadata["source_type"] = "pdf"
             doc.metadata["file_name"] = path.name
 
-        print(f"Loaded {len(docs)} chunks from {path.name}")
+        logger.debug("Loaded %d chunks from %s", len(docs), path.name)
+        _doc_cache_put(cache_key, docs)
         return docs
 
     # Case 2: JSON input (either QA pairs or question lists)
@@ -61,6 +137,7 @@ def load_documents(file_path: str):
                         metadata={"source_type": "json_questions"}
                     )
                 )
+        _doc_cache_put(cache_key, docs)
         return docs
 
     # Unsupported file types
@@ -30,14 +30,14 @@ def test_valid_request(monkeypatch):
     """
 
     # Mock dependencies to avoid actual OpenAI / FAISS calls
-    def mock_load(_):
+    def mock_load(_, cache_key=None):
         return [{"page_content": "fake content", "metadata": {"source_type": "pdf"}}]
 
-    def mock_build_retriever(_):
+    async def mock_build_retriever(_, cache_key=None):
         return "mock_retriever"
 
     class DummyChain:
-        def invoke(self, q):
+        async def ainvoke(self, q):
             return {"result": "mock answer"}
 
     def mock_build_chain(_):
@@ -6,18 +6,20 @@ from langchain_core.documents import Document
 def test_pdf_loading(monkeypatch, tmp_path):
     """
     Verifies that load_documents() correctly processes a PDF file.
-    Instead of parsing a real PDF, we mock PyPDFLoader.load()
-    to return a valid Document object so the splitter logic can run.
+    Instead of parsing a real PDF, we mock PyMuPDFLoader.lazy_load()
+    to yield a valid Document object so the splitter logic can run.
     """
 
     # Create a temporary fake PDF file
     fake_pdf = tmp_path / "fake.pdf"
     fake_pdf.write_bytes(b"%PDF-1.4\nFake minimal PDF content\n%%EOF")
 
-    # Mock out PyPDFLoader.load() to skip actual parsing
+    # Mock out PyMuPDFLoader.lazy_load() to skip actual parsing
     monkeypatch.setattr(
-        "app.services.loader.PyPDFLoader.load",
-        lambda self: [Document(page_content="Hello from PDF", metadata={"source": str(fake_pdf)})],
+        "app.services.loader.PyMuPDFLoader.lazy_load",
+        lambda self: iter(
+            [Document(page_content="Hello from PDF", metadata={"source": str(fake_pdf)})]
+        ),
     )
 
     # Run loader and verify output
@@ -0,0 +1,131 @@
+import pickle
+
+import numpy as np
+import faiss
+from langchain_core.documents import Document
+
+from app.services import qa_chain
+from app.services.qa_chain import VectorizedBM25Retriever
+
+
+class FakeVectorStore:
+    """Minimal stand-in for the LangChain FAISS wrapper — just holds an index."""
+
+    def __init__(self, index):
+        self.index = index
+
+
+def _random_flat_index(n, d, seed=7):
+    rng = np.random.default_rng(seed)
+    vectors = rng.random((n, d), dtype="float32")
+    index = faiss.IndexFlatL2(d)
+    index.add(vectors)
+    return index, vectors
+
+
+def test_compress_index_noop_below_threshold():
+    """Small corpora keep their exact flat index untouched."""
+    flat, _ = _random_flat_index(32, 16)
+    store = FakeVectorStore(flat)
+
+    qa_chain._maybe_compress_index(store, 32)
+
+    assert store.index is flat
+
+
+def test_compress_index_swaps_to_ivfpq_with_l2_metric(monkeypatch):
+    """
+    Past the chunk threshold the flat index is replaced by a trained IVF+PQ
+    index that keeps METRIC_L2 — the LangChain wrapper treats scores as
+    Euclidean distances, so the metric must match the flat index it replaces.
+    A tiny factory string stands in for the production one to keep training fast.
+    """
+    monkeypatch.setattr(qa_chain, "IVFPQ_CHUNK_THRESHOLD", 64)
+    monkeypatch.setattr(qa_chain, "IVFPQ_FACTORY", "IVF4,PQ4")
+
+    flat, vectors = _random_flat_index(512, 16)
+    store = FakeVectorStore(flat)
+
+    qa_chain._maybe_compress_index(store, 512)
+
+    assert store.index is not flat
+    assert store.index.metric_type == faiss.METRIC_L2
+    assert store.index.ntotal == 512
+
+    # With an L2 metric each query's nearest neighbour should (approximately)
+    # be itself; allow a couple of misses from PQ quantization error
+    _, ids = store.index.search(vectors[:8], 1)
+    assert (ids.ravel() == np.arange(8)).sum() >= 6
+
+
+# Small in-memory corpus with distinct vocabulary per document so expected
+# rankings are unambiguous
+BM25_CORPUS = [
+    Document(page_content="The cloud provider hosts customer data in us-east."),
+    Document(page_content="Vendors and subprocessors must sign a data processing agreement."),
+    Document(page_content="Incident notification happens within 72 hours of detection."),
+    Document(page_content="Encryption at rest uses AES-256 for all customer data."),
+]
+
+
+def _bm25_retriever(k=3):
+    return VectorizedBM25Retriever.from_documents(BM25_CORPUS, k=k)
+
+
+def test_bm25_ranks_exact_keyword_match_first():
+    """The document containing the query's rare terms should rank first."""
+    retriever = _bm25_retriever()
+
+    results = retriever.invoke("incident notification within 72 hours")
+
+    assert results[0].page_content == BM25_CORPUS[2].page_content
+
+
+def test_bm25_shared_terms_rank_by_overlap():
+    """'customer data' appears in two docs; both should outrank the rest."""
+    retriever = _bm25_retriever()
+
+    results = retriever.invoke("customer data encryption at rest")
+    contents = [doc.page_content for doc in results]
+
+    # Doc 3 matches every query term, doc 0 only 'customer data'
+    assert contents[0] == BM25_CORPUS[3].page_content
+    assert BM25_CORPUS[0].page_content in contents
+
+
+def test_bm25_empty_and_unknown_queries_return_nothing():
+    """Queries with no indexed terms (or no terms at all) yield no documents."""
+    retriever = _bm25_retriever()
+
+    assert retriever.invoke("") == []
+    assert retriever.invoke("zzz qqq xyzzy") == []
+
+
+def test_bm25_excludes_zero_score_documents():
+    """Documents sharing no terms with the query must not pad out the top k."""
+    retriever = _bm25_retriever(k=4)
+
+    results = retriever.invoke("AES-256")
+
+    assert [doc.page_content for doc in results] == [BM25_CORPUS[3].page_content]
+
+
+def test_bm25_k_larger_than_corpus():
+    """Asking for more results than documents must not raise."""
+    retriever = _bm25_retriever(k=50)
+
+    results = retriever.invoke("customer data")
+
+    assert 0 < len(results) <= len(BM25_CORPUS)
+
+
+def test_bm25_pickle_round_trip():
+    """The retriever is persisted per document hash; rankings must survive pickling."""
+    retriever = _bm25_retriever()
+    restored = pickle.loads(pickle.dumps(retriever))
+
+    query = "incident notification within 72 hours"
+    original = [doc.page_content for doc in retriever.invoke(query)]
+    reloaded = [doc.page_content for doc in restored.invoke(query)]
+
+    assert original == reloaded